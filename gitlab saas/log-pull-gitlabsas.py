@@ -2,12 +2,16 @@
 
 import os
 import requests
-import json
+import orjson
 import logging
-from datetime import datetime, timedelta
-from typing import List
+import queue
+import subprocess
+import threading
+import xxhash
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-from dateutil import parser
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Load environment variables from .env file
 load_dotenv('/var/log/.env')
@@ -15,57 +19,191 @@ load_dotenv('/var/log/.env')
 # Configuration
 LOG_FILE_DIR = 'logs'
 LOG_FILE_PATH = os.path.join(LOG_FILE_DIR, '/var/log/gitlab-logs/gitlab-events.log')
-LIMIT = 1000  # Maximum number of records per request
+ID_INDEX_PATH = LOG_FILE_PATH + '.ids'  # Sidecar file holding one dedup key per line
+CHECKPOINT_PATH = LOG_FILE_PATH + '.ckpt'  # Tiny file holding the resume cursor
+ROTATE_SIZE = 256 << 20  # Rotate the active log segment past 256 MiB
+PAGE_SIZE = 100  # Audit events per GraphQL page (API maximum)
+SOURCE_PREFIX = b'{"source":"gitlab-events",'  # Pre-serialized constant event prefix
+
+# Dedup entries older than this window are pruned on load; the server never
+# replays events older than its own retention, so they can't recur
+LOOKBACK = timedelta(days=int(os.getenv('DEDUP_LOOKBACK_DAYS', '30')))
+QUEUE_MAX_PAGES = 8  # Pages buffered between the fetcher and the writer thread
+
+# One round-trip per cursor page, returning only the fields we ship to Wazuh;
+# avoids the REST offset pagination and its 10k-record x-total-pages cutoff
+AUDIT_EVENTS_QUERY = """
+query($fullPath: ID!, $first: Int!, $cursor: String, $createdAfter: Time) {
+  group(fullPath: $fullPath) {
+    auditEvents(first: $first, after: $cursor, createdAfter: $createdAfter) {
+      pageInfo {
+        endCursor
+        hasNextPage
+      }
+      nodes {
+        id
+        createdAt
+        eventName
+        targetId
+        targetType
+        targetDetails
+        entityId
+        entityType
+        ipAddress
+        author {
+          id
+          name
+        }
+        details
+      }
+    }
+  }
+}
+"""
+
+# Shared session so paginated requests reuse pooled TCP/TLS connections,
+# with retries on transient errors and gzip-compressed response bodies
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504])
+))
+SESSION.headers.update({'Accept-Encoding': 'gzip'})
 
 # Retrieve GitLab API key from environment variable
 GITLAB_API_KEY = os.getenv('GITLAB_API_KEY')
 
+# HTTP headers for GitLab SaaS, built once at import time so every request
+# (including pagination workers) reuses the same dict
+_HEADERS = {
+    'PRIVATE-TOKEN': GITLAB_API_KEY
+}
+
 # Ensure the log directory exists
 if not os.path.exists(LOG_FILE_DIR):
     os.makedirs(LOG_FILE_DIR)
 
-def _get_gitlab_api_key() -> dict:
-    """Prepare HTTP headers with GitLab API key for SaaS."""
-    return {
-        'PRIVATE-TOKEN': GITLAB_API_KEY
-    }
+def _normalize_audit_event(node: dict) -> dict:
+    """Map a GraphQL audit event node onto the REST field names the writer,
+    dedup index, and checkpoint logic already rely on."""
+    event = dict(node)
+    if 'createdAt' in event:
+        event['created_at'] = event.pop('createdAt')
+    # Global IDs look like gid://gitlab/AuditEvent/123; keep the numeric tail
+    event['id'] = str(event.get('id', '')).rsplit('/', 1)[-1]
+    return event
 
-def get_logs(url: str, headers: dict, params: dict, results: List[dict] = []) -> List[dict]:
-    """Fetch logs from GitLab API with pagination."""
-    logging.debug(f"Requesting URL: {url} with params: {params}")
-    response = requests.get(url, params=params, headers=headers)
-    logging.debug(f"Response status code: {response.status_code}")
-    
-    if response.status_code == 200:
-        data = response.json()
-        logging.debug(f"Response content: {data}")  # Debug: Log the response content
-        
-        if data:
-            results.extend(data)
-        
-            # Handle pagination
-            total_pages = int(response.headers.get("x-total-pages", 1))
-            current_page = int(response.headers.get("x-page", 1))
-
-            if current_page < total_pages:
-                params["page"] += 1
-                return get_logs(url, headers, params, results)
-        return results
-    else:
-        logging.error(f"Failed to fetch logs: {response.status_code} {response.text}")
-        return []
+def get_logs(url: str, headers: dict, variables: dict, sink: queue.Queue) -> int:
+    """Fetch audit events from the GitLab GraphQL API, streaming each page
+    of results onto sink.
+
+    Returns the number of events fetched; the writer thread draining sink
+    flattens and appends them while the next pages are still in flight.
+    """
+    total = 0
+    cursor = None
+
+    while True:
+        payload = {
+            'query': AUDIT_EVENTS_QUERY,
+            'variables': {**variables, 'first': PAGE_SIZE, 'cursor': cursor}
+        }
+        logging.debug(f"Requesting URL: {url} with variables: {payload['variables']}")
+        response = SESSION.post(url, json=payload, headers=headers)
+        logging.debug(f"Response status code: {response.status_code}")
+
+        if response.status_code != 200:
+            logging.error(f"Failed to fetch logs: {response.status_code} {response.text}")
+            break
+
+        body = response.json()
+        if body.get('errors'):
+            logging.error(f"GraphQL errors: {body['errors']}")
+            break
+
+        group = (body.get('data') or {}).get('group') or {}
+        audit_events = group.get('auditEvents') or {}
+        nodes = audit_events.get('nodes') or []
+        logging.debug(f"Response content: {nodes}")  # Debug: Log the response content
+
+        if nodes:
+            total += len(nodes)
+            sink.put([_normalize_audit_event(node) for node in nodes])
+
+        page_info = audit_events.get('pageInfo') or {}
+        if not page_info.get('hasNextPage'):
+            break
+        cursor = page_info.get('endCursor')
+
+    return total
+
+def iter_lines_reversed(path, chunk_size=8192):
+    """Yield the lines of a file from last to first, reading fixed-size
+    chunks backwards from EOF so the whole file is never held in memory."""
+    with open(path, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        position = file.tell()
+        buffer = b''
+        while position > 0:
+            step = min(chunk_size, position)
+            position -= step
+            file.seek(position)
+            buffer = file.read(step) + buffer
+            while True:
+                newline = buffer.rfind(b'\n')
+                if newline == -1:
+                    break
+                line = buffer[newline + 1:]
+                buffer = buffer[:newline]
+                if line.strip():
+                    yield line
+        if buffer.strip():
+            yield buffer
+
+def _parse_iso(value):
+    """Parse a canonical ISO-8601 timestamp with datetime.fromisoformat,
+    mapping the trailing 'Z' the APIs emit onto an explicit UTC offset.
+    Non-string values (a JSON null or number) raise TypeError so callers
+    can treat them like any other unparseable timestamp."""
+    if not isinstance(value, str):
+        raise TypeError(f'expected an ISO-8601 string, got {type(value).__name__}')
+    return datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+
+def save_checkpoint(timestamp):
+    """Atomically persist the resume cursor to the checkpoint file."""
+    temp_path = CHECKPOINT_PATH + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(orjson.dumps({'cursor': timestamp}))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, CHECKPOINT_PATH)
 
 def get_last_timestamp():
-    """Retrieve the last timestamp from the log file or default to a timestamp 5 hours ago."""
-    if os.path.exists(LOG_FILE_PATH) and os.path.getsize(LOG_FILE_PATH) > 0:
-        with open(LOG_FILE_PATH, 'r') as file:
-            for line in reversed(list(file)):
-                try:
-                    event = json.loads(line)
-                    return parser.isoparse(event['created_at']).strftime('%Y-%m-%dT%H:%M:%SZ')
-                except json.JSONDecodeError:
-                    logging.error("Failed to decode JSON line: %s", line)
-                    continue  # Skip invalid lines
+    """Retrieve the last timestamp from the checkpoint file, falling back to a
+    tail scan of the log file, or to a timestamp 5 hours ago when both are empty."""
+    try:
+        with open(CHECKPOINT_PATH, 'rb') as file:
+            checkpoint = orjson.loads(file.read())
+        return _parse_iso(checkpoint['cursor']).strftime('%Y-%m-%dT%H:%M:%SZ')
+    except (FileNotFoundError, KeyError, ValueError, TypeError):
+        # ValueError covers both a corrupt checkpoint (orjson.JSONDecodeError
+        # subclasses it) and an unparseable cursor timestamp; TypeError a
+        # cursor that is not a string at all (e.g. JSON null)
+        pass
+    # One stat call tells us both whether the log exists and whether it is empty
+    try:
+        log_size = os.stat(LOG_FILE_PATH).st_size
+    except FileNotFoundError:
+        log_size = 0
+    if log_size > 0:
+        for line in iter_lines_reversed(LOG_FILE_PATH):
+            try:
+                event = orjson.loads(line)
+                return _parse_iso(event['created_at']).strftime('%Y-%m-%dT%H:%M:%SZ')
+            except (KeyError, ValueError, TypeError):
+                logging.error("Failed to parse JSON line: %s", line)
+                continue  # Skip invalid lines
     # Default to 5 hours ago if the log file is empty
     return (datetime.utcnow() - timedelta(hours=5)).strftime('%Y-%m-%dT%H:%M:%SZ')
 
@@ -88,56 +226,181 @@ def flatten_details_field(event):
 
     return flattened_event
 
-def write_logs(events):
-    """Write events to the log file, adding a source field and avoiding duplicates."""
-    existing_ids = set()
-    
+def _before_lookback(timestamp, cutoff):
+    """Whether a dedup entry's timestamp falls outside the lookback window.
+    Unparseable timestamps are retained rather than pruned."""
+    try:
+        return _parse_iso(timestamp) < cutoff
+    except (ValueError, TypeError):
+        return False
+
+def load_id_index(path):
+    """Load the dedup key index from its sidecar file.
+
+    Each line is '<timestamp> <xxh64 digest>' of a dedup key, so the
+    in-memory set holds 8-byte integers instead of full key strings.
+    Entries older than LOOKBACK are pruned on load and the trimmed
+    sidecar is rewritten atomically, keeping the index bounded by the
+    event rate rather than the log's age. If the sidecar is missing or
+    unreadable, rebuild it once from the log file so older deployments
+    migrate transparently, then persist it for the next run.
+    """
+    cutoff = datetime.now(timezone.utc) - LOOKBACK
+    existing_hashes = set()
+    kept_lines = []
+    pruned = False
+    try:
+        with open(path, 'r') as file:
+            for line in file:
+                parts = line.split()
+                if not parts:
+                    continue
+                if len(parts) != 2:
+                    # Not the '<timestamp> <digest>' format; raw keys are
+                    # numeric here and would otherwise pass for digests,
+                    # silently disabling dedup — force the rebuild instead
+                    raise ValueError(f'unrecognized sidecar line: {line!r}')
+                if _before_lookback(parts[0], cutoff):
+                    pruned = True
+                    continue
+                existing_hashes.add(int(parts[1]))
+                kept_lines.append(line)
+        if pruned:
+            temp_path = path + '.tmp'
+            with open(temp_path, 'w') as file:
+                file.writelines(kept_lines)
+            os.replace(temp_path, path)
+        return existing_hashes
+    except FileNotFoundError:
+        pass
+    except ValueError:
+        # Sidecar is not in the timestamped-digest format; rebuild it below
+        pass
+
+    # One-time rebuild from the full log file, keeping only the lookback window
+    entries = {}
     if os.path.exists(LOG_FILE_PATH):
         with open(LOG_FILE_PATH, 'r') as file:
             for line in file:
                 try:
-                    log_entry = json.loads(line)
-                    existing_ids.add(log_entry['id'])  # Assuming logs have a unique 'id' field
-                except json.JSONDecodeError:
+                    log_entry = orjson.loads(line)
+                    # Assuming logs have a unique 'id' field
+                    event_hash = xxhash.xxh64_intdigest(str(log_entry['id']))
+                except (orjson.JSONDecodeError, KeyError):
                     logging.error("Failed to decode JSON line: %s", line)
                     continue  # Skip invalid lines
-    
-    with open(LOG_FILE_PATH, 'a') as file:
-        for event in events:
-            event_id = event['id']  # Assuming logs have a unique 'id' field
-            if event_id not in existing_ids:
-                # Create a new dictionary with the source field first
-                modified_event = {
-                    "source": "gitlab-events",
-                    **event  # Unpack the original event fields
-                }
-                file.write(json.dumps(modified_event) + '\n')
-                existing_ids.add(event_id)
+                timestamp = log_entry.get('created_at', '')
+                if not _before_lookback(timestamp, cutoff):
+                    entries[event_hash] = timestamp
+    with open(path, 'w') as file:
+        for event_hash, timestamp in entries.items():
+            file.write(f'{timestamp} {event_hash}\n')
+    return set(entries)
+
+def rotate_log_if_needed():
+    """Rotate the active log segment once it exceeds ROTATE_SIZE.
+
+    The rolled segment is dated and handed to zstd in the background;
+    dedup state lives in the sidecar files, so rolled segments are never
+    re-read and can stay compressed.
+    """
+    try:
+        size = os.stat(LOG_FILE_PATH).st_size
+    except FileNotFoundError:
+        return
+    if size <= ROTATE_SIZE:
+        return
+    date_suffix = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    rotated_path = f'{LOG_FILE_PATH[:-4]}.{date_suffix}.log'
+    os.rename(LOG_FILE_PATH, rotated_path)
+    subprocess.Popen(['zstd', '--rm', '-3', '-q', rotated_path])
+
+def write_logs(sink: queue.Queue, failures: list):
+    """Drain event batches from sink until the None sentinel, flattening and
+    appending them to the log file with a source field and without duplicates.
+
+    Runs in the writer thread: a fatal error is recorded in failures for
+    main() to re-raise after join, and the remaining batches are discarded
+    so the fetcher never blocks on a full queue.
+    """
+    try:
+        rotate_log_if_needed()
+        existing_hashes = load_id_index(ID_INDEX_PATH)
+        max_timestamp = ''
+
+        with open(LOG_FILE_PATH, 'ab', buffering=1 << 20) as file, open(ID_INDEX_PATH, 'a') as index:
+            while True:
+                events = sink.get()
+                if events is None:
+                    break
+                log_chunks = []
+                index_chunks = []
+                for event in events:
+                    if not event:
+                        continue  # The prefix splice below assumes a non-empty dict
+                    event = flatten_details_field(event)
+                    event_id = str(event['id'])  # Assuming logs have a unique 'id' field
+                    created_at = event.get('created_at', '')
+                    if created_at > max_timestamp:
+                        max_timestamp = created_at
+                    event_hash = xxhash.xxh64_intdigest(event_id)
+                    if event_hash not in existing_hashes:
+                        # Splice the pre-serialized source prefix in front of the
+                        # event body instead of rebuilding and re-serializing it
+                        log_chunks.append(SOURCE_PREFIX + orjson.dumps(event)[1:] + b'\n')
+                        index_chunks.append(f'{created_at} {event_hash}\n')
+                        existing_hashes.add(event_hash)
+                # One write per batch instead of one per event
+                if log_chunks:
+                    file.write(b''.join(log_chunks))
+                    index.write(''.join(index_chunks))
+            file.flush()
+            os.fsync(file.fileno())
+            index.flush()
+            os.fsync(index.fileno())
+
+        if max_timestamp:
+            save_checkpoint(max_timestamp)
+    except Exception as err:
+        logging.error(f"Writer thread failed: {err}")
+        failures.append(err)
+        # Keep consuming until the sentinel so get_logs can finish; the
+        # fetched batches are dropped and re-fetched on the next run
+        while sink.get() is not None:
+            pass
 
 def main():
     logging.basicConfig(level=logging.DEBUG)  # Set logging level to DEBUG
     
     # Target for GitLab SaaS
-    target = ('gitlab.com', 53585858)  # Replace with your GitLab SaaS group ID
-    
-    params = {
-        "page": 1,
-        "per_page": LIMIT,
-        "created_after": get_last_timestamp()  # Fetch logs after the last timestamp
+    target = ('gitlab.com', 'my-group')  # Replace with your GitLab SaaS group full path
+
+    variables = {
+        "fullPath": target[1],
+        "createdAfter": get_last_timestamp()  # Fetch logs after the last timestamp
     }
-    
-    headers = _get_gitlab_api_key()
-    url = f"https://{target[0]}/api/v4/groups/{target[1]}/audit_events"
-    logs = get_logs(url, headers, params)
-    
-    if logs:
-        logging.info(f"[*] Logs length: {len(logs)}")
 
-        # Flatten details fields for each log
-        flattened_logs = [flatten_details_field(event) for event in logs]
+    url = f"https://{target[0]}/api/graphql"
+
+    # Bounded queue between the fetcher and the writer thread so peak
+    # memory stays at a few pages while disk writes overlap the HTTP latency
+    sink = queue.Queue(maxsize=QUEUE_MAX_PAGES)
+    writer_failures = []
+    writer = threading.Thread(target=write_logs, args=(sink, writer_failures))
+    writer.start()
+
+    try:
+        total = get_logs(url, _HEADERS, variables, sink)
+    finally:
+        # Always deliver the sentinel, even when the fetch raised, so the
+        # writer thread terminates and the process can exit
+        sink.put(None)
+        writer.join()
+    if writer_failures:
+        raise writer_failures[0]
 
-        # Write the flattened logs to the log file
-        write_logs(flattened_logs)
+    if total:
+        logging.info(f"[*] Logs length: {total}")
     else:
         logging.info("No new events found.")
 
@@ -2,6 +2,7 @@
 
 import os
 import json
+import orjson
 import datetime
 import time
 from google.oauth2 import service_account
@@ -54,27 +55,25 @@ def save_last_timestamps(filename, last_timestamps):
 
 # Flatten nested JSON fields
 def flatten_json(y):
-    """Flatten a nested JSON object."""
-    def flatten(x, name=''):
-        """Recursive helper function for flattening JSON."""
-        if type(x) is dict:
-            for a in x:
-                flatten(x[a], name + a + '_')
-        elif type(x) is list:
-            i = 0
-            for a in x:
-                flatten(a, name + str(i) + '_')
-                i += 1
-        else:
-            out[name[:-1]] = x
-
+    """Flatten a nested JSON object iteratively with an explicit stack."""
     out = {}
-    flatten(y)
+    stack = [(y, '')]
+    while stack:
+        x, prefix = stack.pop()
+        if isinstance(x, dict):
+            for key, value in x.items():
+                stack.append((value, prefix + key + '_'))
+        elif isinstance(x, list):
+            for i, value in enumerate(x):
+                stack.append((value, prefix + str(i) + '_'))
+        else:
+            out[prefix[:-1]] = x
     return out
 
 # Log Retrieval Logic to avoid duplicates
 def fetch_and_log_events(event_type, last_timestamp=None):
-    logs = []
+    total = 0
+    latest_timestamp = None
     page_token = None
 
     while True:
@@ -92,18 +91,25 @@ def fetch_and_log_events(event_type, last_timestamp=None):
             activities = results.get('items', [])
 
             if not activities:
-                print(f'No new logs for {event_type}.')
+                if total == 0:
+                    print(f'No new logs for {event_type}.')
                 break
 
-            for activity in activities:
-                logs.append(activity)
+            # Stream this page to disk before fetching the next one, so peak
+            # memory stays at one page and disk I/O overlaps the API latency
+            save_logs_to_file(activities, log_filename)
+            total += len(activities)
+
+            page_latest = get_latest_timestamp(activities)
+            if page_latest and (latest_timestamp is None or page_latest > latest_timestamp):
+                latest_timestamp = page_latest
 
             page_token = results.get('nextPageToken', None)
 
             # Stop if there are no more pages to fetch
             if not page_token:
                 break
-            
+
             # Pause for a short time to avoid hitting API rate limits
             time.sleep(1)
 
@@ -111,8 +117,8 @@ def fetch_and_log_events(event_type, last_timestamp=None):
             print(f"An error occurred: {error}")
             break
 
-    # Return logs
-    return logs
+    # Return how many logs were written and the newest timestamp seen
+    return total, latest_timestamp
 
 # Function to get the latest timestamp from the logs to avoid duplicates
 def get_latest_timestamp(logs):
@@ -122,7 +128,7 @@ def get_latest_timestamp(logs):
 # Save logs to a single local JSON file
 def save_logs_to_file(logs, filename):
     if logs:
-        with open(filename, 'a') as f:
+        with open(filename, 'ab') as f:
             for log in logs:
                 # Flatten the log entry
                 flattened_log = flatten_json(log)
@@ -130,8 +136,7 @@ def save_logs_to_file(logs, filename):
                 log_with_source = {'source': 'google-workspace'}
                 log_with_source.update(flattened_log)
                 # Write the log with 'source' as the first key to the file
-                json.dump(log_with_source, f)
-                f.write('\n')  # Add a newline for clarity between batches
+                f.write(orjson.dumps(log_with_source, option=orjson.OPT_APPEND_NEWLINE))
 
 # Main logic to pull logs and avoid duplicates across runs
 def main():
@@ -144,17 +149,15 @@ def main():
         # Get the last known timestamp for the event type
         last_timestamp = last_timestamps.get(event_type)
 
-        # Fetch logs
-        logs = fetch_and_log_events(event_type, last_timestamp)
+        # Fetch logs, writing each page to the log file as it arrives
+        total, latest_timestamp = fetch_and_log_events(event_type, last_timestamp)
 
         # Update the last timestamp to avoid duplicates
-        if logs:
-            last_timestamps[event_type] = get_latest_timestamp(logs)
+        if latest_timestamp:
+            last_timestamps[event_type] = latest_timestamp
 
-        # Save logs to a single file
-        if logs:
-            save_logs_to_file(logs, log_filename)
-            print(f'Saved {len(logs)} logs for {event_type}.')
+        if total:
+            print(f'Saved {total} logs for {event_type}.')
 
         # Pause for a short time between event types to avoid rate limiting
         time.sleep(2)
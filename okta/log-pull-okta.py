@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 
-import json
+import orjson
 import os
 import requests
-from datetime import datetime, timedelta
+import struct
+import subprocess
+import xxhash
+from datetime import datetime, timedelta, timezone
 from urllib.parse import urlencode
 from dotenv import load_dotenv
+from pybloom_live import ScalableBloomFilter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Load environment variables from .env file located in /var/log - the env file has chmod 600 set (root)
 load_dotenv('/var/log/.env')
@@ -15,109 +21,342 @@ OKTA_DOMAIN = os.getenv('OKTA_DOMAIN', 'paydock.okta.com')  # Default if not set
 OKTA_API_TOKEN = os.getenv('OKTA_API_TOKEN')  # Fetch from .env
 LOG_FILE_DIR = 'logs'
 LOG_FILE_PATH = '/var/log/okta-logs/okta-events.log'
+ID_INDEX_PATH = LOG_FILE_PATH + '.ids'  # Sidecar file holding one dedup key per line
+CHECKPOINT_PATH = LOG_FILE_PATH + '.ckpt'  # Tiny file holding the resume cursor
+BLOOM_PATH = LOG_FILE_PATH + '.bloom'  # Persistent Bloom filter over the dedup keys
+BLOOM_ERROR_RATE = 0.000001  # A false positive skips ~1 event per million
+ROTATE_SIZE = 256 << 20  # Rotate the active log segment past 256 MiB
 LIMIT = 1000  # Maximum number of records per request
+SOURCE_PREFIX = b'{"source":"okta-events",'  # Pre-serialized constant event prefix
+
+# Dedup entries older than this window are pruned on load; the server never
+# replays events older than its own retention, so they can't recur
+LOOKBACK = timedelta(days=int(os.getenv('DEDUP_LOOKBACK_DAYS', '30')))
+
+# Shared session so repeated requests reuse pooled TCP/TLS connections,
+# with retries on transient errors and gzip-compressed response bodies
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504])
+))
+SESSION.headers.update({'Accept-Encoding': 'gzip'})
 
 # Ensure the log directory exists
 if not os.path.exists(os.path.dirname(LOG_FILE_PATH)):
     os.makedirs(os.path.dirname(LOG_FILE_PATH))
 
 def fetch_events(start_time):
-    """Fetch Okta events from the API starting from the given start time."""
+    """Yield Okta events from the API starting from the given start time.
+
+    The System Log API pages its results via the Link rel=\"next\" header;
+    follow it until it disappears so no events past the first page are lost.
+    """
     url = f'https://{OKTA_DOMAIN}/api/v1/logs'
     headers = {'Authorization': f'SSWS {OKTA_API_TOKEN}'}
     params = {
         'since': start_time.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
         'limit': LIMIT
     }
-    
+
     query_string = urlencode(params)
     request_url = f'{url}?{query_string}'
-    
-    try:
-        response = requests.get(request_url, headers=headers, timeout=60)
-        response.raise_for_status()  # Raise an exception for HTTP errors
-        return response.json()
-    except requests.exceptions.HTTPError as err:
-        print(f"HTTP error occurred: {err}")
-        print(f"Response content: {response.text}")
-        raise
-    except requests.exceptions.RequestException as err:
-        print(f"Error occurred: {err}")
-        raise
+
+    while request_url:
+        try:
+            response = SESSION.get(request_url, headers=headers, timeout=60)
+            response.raise_for_status()  # Raise an exception for HTTP errors
+        except requests.exceptions.HTTPError as err:
+            print(f"HTTP error occurred: {err}")
+            print(f"Response content: {response.text}")
+            raise
+        except requests.exceptions.RequestException as err:
+            print(f"Error occurred: {err}")
+            raise
+        yield from response.json()
+        request_url = response.links.get('next', {}).get('url')
+
+def iter_lines_reversed(path, chunk_size=8192):
+    """Yield the lines of a file from last to first, reading fixed-size
+    chunks backwards from EOF so the whole file is never held in memory."""
+    with open(path, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        position = file.tell()
+        buffer = b''
+        while position > 0:
+            step = min(chunk_size, position)
+            position -= step
+            file.seek(position)
+            buffer = file.read(step) + buffer
+            while True:
+                newline = buffer.rfind(b'\n')
+                if newline == -1:
+                    break
+                line = buffer[newline + 1:]
+                buffer = buffer[:newline]
+                if line.strip():
+                    yield line
+        if buffer.strip():
+            yield buffer
+
+def _parse_iso(value):
+    """Parse a canonical ISO-8601 timestamp with datetime.fromisoformat,
+    mapping the trailing 'Z' the APIs emit onto an explicit UTC offset.
+    Non-string values (a JSON null or number) raise TypeError so callers
+    can treat them like any other unparseable timestamp."""
+    if not isinstance(value, str):
+        raise TypeError(f'expected an ISO-8601 string, got {type(value).__name__}')
+    return datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+
+def save_checkpoint(timestamp):
+    """Atomically persist the resume cursor to the checkpoint file."""
+    temp_path = CHECKPOINT_PATH + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(orjson.dumps({'cursor': timestamp}))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, CHECKPOINT_PATH)
 
 def get_last_timestamp():
-    """Retrieve the last timestamp from the log file."""
-    if os.path.exists(LOG_FILE_PATH):
-        with open(LOG_FILE_PATH, 'r') as file:
-            for line in reversed(list(file)):
-                try:
-                    event = json.loads(line)
-                    return datetime.fromisoformat(event['published'].replace('Z', '+00:00'))
-                except json.JSONDecodeError:
-                    # Skip lines that cannot be decoded as JSON
-                    continue
+    """Retrieve the last timestamp from the checkpoint file, falling back
+    to a tail scan of the log file when no checkpoint exists yet."""
+    try:
+        with open(CHECKPOINT_PATH, 'rb') as file:
+            checkpoint = orjson.loads(file.read())
+        return _parse_iso(checkpoint['cursor'])
+    except (FileNotFoundError, KeyError, ValueError, TypeError):
+        # ValueError covers both a corrupt checkpoint (orjson.JSONDecodeError
+        # subclasses it) and an unparseable cursor timestamp; TypeError a
+        # cursor that is not a string at all (e.g. JSON null)
+        pass
+    # One stat call tells us both whether the log exists and whether it is empty
+    try:
+        log_size = os.stat(LOG_FILE_PATH).st_size
+    except FileNotFoundError:
+        log_size = 0
+    if log_size > 0:
+        for line in iter_lines_reversed(LOG_FILE_PATH):
+            try:
+                event = orjson.loads(line)
+                return _parse_iso(event['published'])
+            except (KeyError, ValueError, TypeError):
+                # Skip lines that cannot be decoded or carry a bad timestamp
+                continue
     return datetime.utcnow() - timedelta(minutes=15)
 
 def flatten_target_field(event):
     """Flatten the 'target' field in the event if it's a JSON string."""
-    flattened_event = event.copy()  # Copy the event to modify it
-    if isinstance(event.get('target'), str):
+    target = event.get('target')
+    if isinstance(target, str):
         try:
             # Parse the 'target' field if it's a JSON string
-            target_array = json.loads(event['target'])
-        except json.JSONDecodeError:
+            target_array = orjson.loads(target)
+        except orjson.JSONDecodeError:
             # Handle cases where 'target' field cannot be parsed as JSON
             target_array = []
-    elif isinstance(event.get('target'), list):
+    elif isinstance(target, list):
         # If 'target' is already a list, use it directly
-        target_array = event['target']
+        target_array = target
     else:
         # Handle unexpected types
         target_array = []
 
-    # Flatten the list and add to the event
-    for i, item in enumerate(target_array):
-        if isinstance(item, dict):
-            for key, value in item.items():
-                field_name = f'target_{key}_{i}'
-                flattened_event[field_name] = value
+    # Build the flattened fields in one comprehension and merge without
+    # mutating (or separately copying) the original event
+    flattened_fields = {
+        f'target_{key}_{i}': value
+        for i, item in enumerate(target_array) if isinstance(item, dict)
+        for key, value in item.items()
+    }
+    return {**event, **flattened_fields}
 
-    return flattened_event
+def _before_lookback(timestamp, cutoff):
+    """Whether a dedup entry's timestamp falls outside the lookback window.
+    Unparseable timestamps are retained rather than pruned."""
+    try:
+        return _parse_iso(timestamp) < cutoff
+    except (ValueError, TypeError):
+        return False
 
-def write_logs(events):
-    """Write events to the log file, avoiding duplicates based on timestamp."""
-    existing_timestamps = set()
+def load_id_index(path):
+    """Load the dedup key index from its sidecar file.
+
+    Each line is '<timestamp> <xxh64 digest>' of a dedup key, so the
+    in-memory set holds 8-byte integers instead of full key strings.
+    Entries older than LOOKBACK are pruned on load and the trimmed
+    sidecar is rewritten atomically, keeping the index bounded by the
+    event rate rather than the log's age. If the sidecar is missing or
+    unreadable, rebuild it once from the log file so older deployments
+    migrate transparently, then persist it for the next run.
+
+    Returns (hashes, trimmed) — trimmed is True when entries were pruned
+    or the sidecar was rebuilt, i.e. whenever the Bloom filter no longer
+    matches the sidecar and must be reseeded.
+    """
+    cutoff = datetime.now(timezone.utc) - LOOKBACK
+    existing_hashes = set()
+    kept_lines = []
+    pruned = False
+    try:
+        with open(path, 'r') as file:
+            for line in file:
+                parts = line.split()
+                if not parts:
+                    continue
+                if len(parts) != 2:
+                    # Not the '<timestamp> <digest>' format; force the rebuild
+                    # rather than guess at what an ambiguous line means
+                    raise ValueError(f'unrecognized sidecar line: {line!r}')
+                if _before_lookback(parts[0], cutoff):
+                    pruned = True
+                    continue
+                existing_hashes.add(int(parts[1]))
+                kept_lines.append(line)
+        if pruned:
+            temp_path = path + '.tmp'
+            with open(temp_path, 'w') as file:
+                file.writelines(kept_lines)
+            os.replace(temp_path, path)
+        return existing_hashes, pruned
+    except FileNotFoundError:
+        pass
+    except ValueError:
+        # Sidecar is not in the timestamped-digest format; rebuild it below
+        pass
+
+    # One-time rebuild from the full log file, keeping only the lookback window
+    entries = {}
     if os.path.exists(LOG_FILE_PATH):
         with open(LOG_FILE_PATH, 'r') as file:
             for line in file:
                 try:
-                    log_entry = json.loads(line)
-                    existing_timestamps.add(log_entry['published'])
-                except json.JSONDecodeError:
+                    log_entry = orjson.loads(line)
+                    timestamp = log_entry['published']
+                except (orjson.JSONDecodeError, KeyError):
                     # Skip lines that cannot be decoded as JSON
                     continue
-    
-    with open(LOG_FILE_PATH, 'a') as file:
+                if not _before_lookback(timestamp, cutoff):
+                    entries[xxhash.xxh64_intdigest(timestamp)] = timestamp
+    with open(path, 'w') as file:
+        for key_hash, timestamp in entries.items():
+            file.write(f'{timestamp} {key_hash}\n')
+    return set(entries), True
+
+def load_bloom_filter(path, existing_hashes, reseed):
+    """Load the persistent Bloom filter over the dedup keys.
+
+    Bloom filters cannot delete, so whenever the sidecar was trimmed (or
+    the filter file is missing/unreadable) a fresh scalable filter is
+    seeded from the lookback-bounded sidecar hashes instead — this is the
+    periodic rebuild that keeps the filter's size bounded too.
+    """
+    if not reseed:
+        try:
+            with open(path, 'rb') as file:
+                return ScalableBloomFilter.fromfile(file)
+        except (FileNotFoundError, ValueError, struct.error):
+            # struct.error covers a truncated or corrupt filter file, which
+            # fromfile raises while unpacking the header
+            pass
+
+    bloom = ScalableBloomFilter(initial_capacity=LIMIT * 100, error_rate=BLOOM_ERROR_RATE)
+    for key_hash in existing_hashes:
+        bloom.add(key_hash)
+    return bloom
+
+def save_bloom_filter(path, bloom):
+    """Atomically persist the Bloom filter next to the log file."""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        bloom.tofile(file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+def rotate_log_if_needed():
+    """Rotate the active log segment once it exceeds ROTATE_SIZE.
+
+    The rolled segment is dated and handed to zstd in the background;
+    dedup state lives in the sidecar files, so rolled segments are never
+    re-read and can stay compressed.
+    """
+    try:
+        size = os.stat(LOG_FILE_PATH).st_size
+    except FileNotFoundError:
+        return
+    if size <= ROTATE_SIZE:
+        return
+    date_suffix = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    rotated_path = f'{LOG_FILE_PATH[:-4]}.{date_suffix}.log'
+    os.rename(LOG_FILE_PATH, rotated_path)
+    subprocess.Popen(['zstd', '--rm', '-3', '-q', rotated_path])
+
+def write_logs(events):
+    """Write events to the log file, avoiding duplicates based on timestamp.
+
+    Accepts any iterable of events and returns the number actually written.
+    Batches are flushed once per page-sized chunk (LIMIT events), so peak
+    memory stays at one page and disk I/O overlaps the paginated fetch that
+    feeds the iterable.
+    """
+    rotate_log_if_needed()
+    # Prune the sidecar on every run so dedup state stays lookback-bounded,
+    # reseeding the Bloom filter whenever entries were trimmed away
+    existing_hashes, trimmed = load_id_index(ID_INDEX_PATH)
+    bloom = load_bloom_filter(BLOOM_PATH, existing_hashes, reseed=trimmed)
+    max_timestamp = ''
+    log_chunks = []
+    index_chunks = []
+    written = 0
+
+    with open(LOG_FILE_PATH, 'ab', buffering=1 << 20) as file, open(ID_INDEX_PATH, 'a') as index:
         for event in events:
+            if not event:
+                continue  # The prefix splice below assumes a non-empty dict
             timestamp = event.get('published', '')
-            if timestamp not in existing_timestamps:
-                # Add the source field at the beginning of the event
-                modified_event = {
-                    "source": "okta-events",
-                    **event  # Unpack the original event fields
-                }
-                file.write(json.dumps(modified_event) + '\n')
-                existing_timestamps.add(timestamp)
+            if timestamp > max_timestamp:
+                max_timestamp = timestamp
+            timestamp_hash = xxhash.xxh64_intdigest(timestamp)
+            # add() returns True when the key was (probably) already seen
+            if not bloom.add(timestamp_hash):
+                # Splice the pre-serialized source prefix in front of the event
+                # body instead of rebuilding and re-serializing it per event
+                log_chunks.append(SOURCE_PREFIX + orjson.dumps(event)[1:] + b'\n')
+                index_chunks.append(f'{timestamp} {timestamp_hash}\n')
+            # One write per page-sized batch instead of one per event or
+            # one giant write after the fetch has finished
+            if len(log_chunks) >= LIMIT:
+                file.write(b''.join(log_chunks))
+                index.write(''.join(index_chunks))
+                written += len(log_chunks)
+                log_chunks = []
+                index_chunks = []
+        if log_chunks:
+            file.write(b''.join(log_chunks))
+            index.write(''.join(index_chunks))
+            written += len(log_chunks)
+        # One fsync per file for the whole run
+        if written:
+            file.flush()
+            os.fsync(file.fileno())
+            index.flush()
+            os.fsync(index.fileno())
+
+    save_bloom_filter(BLOOM_PATH, bloom)
+    if max_timestamp:
+        save_checkpoint(max_timestamp)
+    return written
 
 def main():
     start_time = get_last_timestamp()
     print(f'Fetching events since: {start_time}')
+
+    # Stream the paginated fetch straight into write_logs
     events = fetch_events(start_time)
-    
-    if events:
-        flattened_events = [flatten_target_field(event) for event in events]
-        write_logs(flattened_events)
-    else:
+    written = write_logs(flatten_target_field(event) for event in events)
+
+    if not written:
         print('No new events found.')
 
 if __name__ == '__main__':